@@ -4,9 +4,13 @@ import argparse
 import asyncio
 import datetime
 import logging
+import sys
 from pathlib import Path
 
-import pytz
+try:
+    import uvloop
+except ImportError:  # uvloop is optional: fall back to the default asyncio event loop
+    uvloop = None
 
 from binance_klines import constants, utils
 from binance_klines.downloader import BinanceKLinesDownloader, DownloaderException
@@ -18,17 +22,21 @@ DATE_FORMAT = "%Y-%m-%d %H:%M:%S"  # e.g. 2019-11-16 23:16:15
 
 
 @utils.timeit
-async def run_downloader(symbols, start_date, end_date, timeframe, output_dir):
-    downloader = BinanceKLinesDownloader(output_dir=output_dir, logger=LOGGER)
-    # TODO: move in the downloader class?
-    binance_markets = await downloader.get_markets()
-    available_symbols = list(binance_markets)
-    # Check if all symbols are available on Binance
-    missing_symbols = set(symbols) - set(available_symbols)
-    if missing_symbols:
-        raise DownloaderException(f"Some symbols are not available on Binance: {missing_symbols}.")
-
-    await downloader.fetch_klines(symbols, start_date, end_date, timeframe)
+async def run_downloader(symbols, start_date, end_date, timeframe, output_dir, direct_api=False):
+    async with BinanceKLinesDownloader(
+        output_dir=output_dir, logger=LOGGER, direct_api=direct_api
+    ) as downloader:
+        # TODO: move in the downloader class?
+        binance_markets = await downloader.get_markets()
+        available_symbols = list(binance_markets)
+        # Check if all symbols are available on Binance
+        missing_symbols = set(symbols) - set(available_symbols)
+        if missing_symbols:
+            raise DownloaderException(
+                f"Some symbols are not available on Binance: {missing_symbols}."
+            )
+
+        await downloader.fetch_klines(symbols, start_date, end_date, timeframe)
 
 
 def _ask_confirmation() -> bool:
@@ -54,7 +62,9 @@ def _check_dir_path(path: str) -> str:
 def _convert_to_datetime(date_str: str) -> datetime.datetime:
     """Convert a string to a datetime object and add UTC timezone."""
     try:
-        return datetime.datetime.strptime(date_str, DATE_FORMAT).replace(tzinfo=pytz.utc)
+        return datetime.datetime.strptime(date_str, DATE_FORMAT).replace(
+            tzinfo=datetime.timezone.utc
+        )
     except ValueError:
         msg = f"Not a valid date: '{date_str}'. Expected format is {DATE_FORMAT}."
         raise argparse.ArgumentTypeError(msg)
@@ -82,7 +92,7 @@ def parse_cli_arguments():
     )
     parser.add_argument(
         "--end-date",
-        default=datetime.datetime.now(pytz.utc).strftime(DATE_FORMAT),
+        default=datetime.datetime.now(datetime.timezone.utc).strftime(DATE_FORMAT),
         help="Download data up to this date. E.g.: 2020-05-30 00:00:00. Default: now.",
         type=_convert_to_datetime,
     )
@@ -100,6 +110,11 @@ def parse_cli_arguments():
         choices=constants.AVAILABLE_TIMEFRAMES,
         help="The frequency of the OHLCV data to be downloaded. Default: 1h.",
     )
+    parser.add_argument(
+        "--direct-api",
+        action="store_true",
+        help="Fetch klines directly from the Binance API instead of using ccxt (faster).",
+    )
 
     return parser.parse_args()
 
@@ -114,19 +129,38 @@ def _configure_logger(verbosity_level: int):
     loglevels = [logging.INFO, logging.DEBUG]
     loglevel = loglevels[min(verbosity_level, len(loglevels) - 1)]  # Cap to the number of levels
     LOGGER.setLevel(loglevel)
+    # Configure the package logger too, so that the level applies to all binance_klines modules
+    # (LOGGER is not one of its children when running with `python -m binance_klines.cli`)
+    logging.getLogger("binance_klines").setLevel(loglevel)
+
+
+def _run(coroutine):
+    """Run a coroutine in a new event loop, using uvloop if available."""
+    if uvloop is None:
+        return asyncio.run(coroutine)
+
+    # uvloop's event loop has a lower overhead per I/O wakeup than the default one
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(coroutine)
+
+    # Python 3.10 has no asyncio.Runner (event loop policies are deprecated since 3.14)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(coroutine)
 
 
 def main():
     arguments = parse_cli_arguments()
     _configure_logger(arguments.verbose)
 
-    asyncio.run(
+    _run(
         run_downloader(
             symbols=arguments.symbols,
             start_date=arguments.start_date,
             end_date=arguments.end_date,
             output_dir=arguments.output_dir,
             timeframe=arguments.timeframe,
+            direct_api=arguments.direct_api,
         )
     )
 
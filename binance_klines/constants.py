@@ -1,3 +1,5 @@
+from pathlib import Path
+
 AVAILABLE_TIMEFRAMES = [
     "1m",
     "3m",
@@ -15,3 +17,32 @@ AVAILABLE_TIMEFRAMES = [
     "1w",
     "1M",
 ]
+
+# Duration of each timeframe in milliseconds. "1M" uses the shortest month (28 days), so that a
+# range of N klines never holds more than N monthly klines.
+TIMEFRAME_MS = {
+    "1m": 60_000,
+    "3m": 3 * 60_000,
+    "5m": 5 * 60_000,
+    "15m": 15 * 60_000,
+    "30m": 30 * 60_000,
+    "1h": 3_600_000,
+    "2h": 2 * 3_600_000,
+    "4h": 4 * 3_600_000,
+    "6h": 6 * 3_600_000,
+    "8h": 8 * 3_600_000,
+    "12h": 12 * 3_600_000,
+    "1d": 86_400_000,
+    "3d": 3 * 86_400_000,
+    "1w": 7 * 86_400_000,
+    "1M": 28 * 86_400_000,
+}
+
+BINANCE_KLINES_URL = "https://api.binance.com/api/v3/klines"
+BINANCE_MAX_KLINES_LIMIT = 1000  # Maximum number of klines returned by a single request
+BINANCE_INVALID_SYMBOL_CODE = -1121  # Error code returned by Binance for an unknown symbol
+
+MARKETS_CACHE_PATH = Path.home() / ".cache" / "binance_klines" / "markets.json"
+MARKETS_CACHE_TTL = 24 * 60 * 60  # Seconds
+
+WRITE_BATCH_SIZE = 10_000  # Number of klines accumulated before writing them to disk
@@ -4,16 +4,49 @@ Fetch OHLCV klines from Binance.
 
 """
 import asyncio
+import collections
 import datetime
+import itertools
+import json
 import logging
+import ssl
+import sys
+import time
 from pathlib import Path
 
+import aiohttp
 import ccxt.async_support as ccxt  # link against the asynchronous version of ccxt
-import pytz
 from ccxt.base.errors import BadSymbol
 
-from binance_klines.constants import AVAILABLE_TIMEFRAMES
-from binance_klines.utils import write_data_to_file
+try:
+    import orjson
+except ImportError:  # orjson is optional: fall back to ccxt's JSON parser
+    orjson = None
+
+from binance_klines.constants import (
+    AVAILABLE_TIMEFRAMES,
+    BINANCE_INVALID_SYMBOL_CODE,
+    BINANCE_KLINES_URL,
+    BINANCE_MAX_KLINES_LIMIT,
+    MARKETS_CACHE_PATH,
+    MARKETS_CACHE_TTL,
+    TIMEFRAME_MS,
+    WRITE_BATCH_SIZE,
+)
+from binance_klines.utils import append_batch, open_csv_file, to_milliseconds
+
+
+UTC = datetime.timezone.utc
+ZERO_OFFSET = datetime.timedelta(0)
+# SSL connections closed without a shutdown leak until https://github.com/python/cpython/pull/118960
+# (Python 3.12.8 and 3.13.1): newer aiohttp versions warn if the workaround is enabled there
+NEEDS_CLEANUP_CLOSED = sys.version_info < (3, 12, 8) or (3, 13, 0) <= sys.version_info < (3, 13, 1)
+
+
+def _loads(body: bytes):
+    """Parse a JSON response body, with orjson if available."""
+    # Both parsers accept bytes, which avoids decoding the body to a string first
+    return orjson.loads(body) if orjson is not None else json.loads(body)
 
 
 class DownloaderException(Exception):
@@ -24,27 +57,73 @@ class BinanceKLinesDownloader:
     """Downloader for OHLCV klines.
 
     Args:
-        limit (int, optional): Number of klines to fetch per request. Defaults to 500.
+        limit (int, optional): Number of klines to fetch per request. Binance returns at most
+            1000 klines per request. Defaults to 500.
         output_dir (str | Path, optional): Directory where to store the downloaded data.
         logger (logging.Logger, optional): Logger to use. Defaults to None.
+        max_concurrent_windows (int, optional): Number of date windows (of `limit` klines each)
+            fetched concurrently for each symbol. Defaults to 8.
+        max_concurrent_symbols (int, optional): Number of symbols downloaded concurrently.
+            Defaults to 8.
+        max_concurrent_requests (int, optional): Number of requests sent concurrently to Binance,
+            across all symbols. Defaults to 16.
+        markets_cache_path (str | Path | None, optional): File where the Binance markets are
+            cached. Set to None to disable the cache. Defaults to MARKETS_CACHE_PATH.
+        direct_api (bool, optional): Fetch klines directly from the Binance REST API instead of
+            going through ccxt, which adds some overhead to each request. Defaults to False.
+        pages_per_batch (int, optional): Number of pages (requests of `limit` klines) merged
+            into each batch of klines. Defaults to 8.
     """
 
     def __init__(
-        self, limit: int = 500, output_dir: str | Path = ".", logger: logging.Logger | None = None
+        self,
+        limit: int = 500,
+        output_dir: str | Path = ".",
+        logger: logging.Logger | None = None,
+        max_concurrent_windows: int = 8,
+        max_concurrent_symbols: int = 8,
+        max_concurrent_requests: int = 16,
+        markets_cache_path: str | Path | None = MARKETS_CACHE_PATH,
+        direct_api: bool = False,
+        pages_per_batch: int = 8,
     ) -> None:
         self.limit = limit
+        self.pages_per_batch = pages_per_batch
+        self.direct_api = direct_api
+        self.max_concurrent_windows = max_concurrent_windows
+        self._symbols_semaphore = asyncio.Semaphore(max_concurrent_symbols)
+        self._requests_semaphore = asyncio.Semaphore(max_concurrent_requests)
         self.output_dir = Path(output_dir)
+        self.markets_cache_path = Path(markets_cache_path) if markets_cache_path else None
         self._markets = None
         self._logger = logger or logging.getLogger(__name__)
 
         self._instantiate_exchange()
 
+    async def __aenter__(self):
+        await self._open_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Release the resources (e.g. the HTTP connections) used by the exchange.
+
+        Binance requires to release all resources with an explicit call to the .close() coroutine
+        when you don't need the exchange instance anymore. Using the downloader as an async
+        context manager does it automatically, while reusing the connections for all the
+        downloads made inside the context.
+        """
+        await self.exchange.close()
+
     async def fetch_klines(
         self,
         symbols: list[str],
         start_date: datetime.datetime,
         end_date: datetime.datetime,
         timeframe: str = "1h",
+        return_data: bool = False,
     ):
         """Download OHCLV data (klines).
 
@@ -54,9 +133,13 @@ class BinanceKLinesDownloader:
             start_date (datetime.datetime): Start date (UTC timezone)
             end_date (datetime.datetime): End date (UTC timezone)
             timeframe (str, optional): Timeframe to download. Defaults to "1h".
+            return_data (bool, optional): Return the downloaded klines, besides writing them to
+                the CSV files. This keeps all of them in memory. Defaults to False.
 
-        Yields:
-            List[int]: a list of OHLCV lines. Structure of each kline:
+        Returns:
+            list: for each symbol (in the order of `symbols`), the number of downloaded klines,
+                or the list of kline batches if `return_data` is True. Each batch is a list of
+                OHLCV lines. Structure of each kline:
                 [
                     1504541580000, // UTC timestamp in milliseconds, integer
                     4235.4,        // (O)pen price, float
@@ -70,64 +153,125 @@ class BinanceKLinesDownloader:
         start_date = self._preprocess_date(start_date)
         end_date = self._preprocess_date(end_date)
 
-        assert start_date.tzinfo == pytz.utc, "Dates must be in UTC timezone"
-        assert end_date.tzinfo == pytz.utc, "Dates must be in UTC timezone"
+        # Accept any UTC-equivalent timezone (e.g. both pytz.utc and datetime.timezone.utc)
+        if start_date.utcoffset() != ZERO_OFFSET or end_date.utcoffset() != ZERO_OFFSET:
+            raise DownloaderException("Dates must be in UTC timezone")
 
         if timeframe not in AVAILABLE_TIMEFRAMES:
             raise DownloaderException(
                 f"Invalid timeframe: {timeframe}. Available timeframes: {AVAILABLE_TIMEFRAMES}"
             )
 
-        try:
-            results = await asyncio.gather(
-                *[
-                    self._fetch_and_store_klines_for_symbol(
-                        symbol, start_date, end_date, timeframe
-                    )
-                    for symbol in symbols
-                ]
+        # Convert UTC dates to timestamps in milliseconds (needed by Binance API), once for all
+        # the symbols
+        start_timestamp = to_milliseconds(start_date)
+        end_timestamp = to_milliseconds(end_date)
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        await self._open_session()
+        if not self.direct_api:
+            # ccxt loads the markets on the first request, making the concurrent requests of all
+            # the symbols wait for it: load them (or read them from the cache) beforehand
+            await self.get_markets()
+
+        tasks = [
+            asyncio.create_task(
+                self._fetch_and_store_klines_for_symbol(
+                    symbol, start_timestamp, end_timestamp, timeframe, return_data
+                )
             )
-            # This is the synchronous version (if you want to compare the performance)
-            # for symbol in symbols:
-            #     await _fetch_and_store_klines_for_symbol(downloader, symbol, start_date, end_date, timeframe)
-        finally:
-            # Binance requires to release all resources with an explicit call to the .close()
-            # coroutine when you don't need the exchange instance anymore (at the end of your a
-            # sync coroutine).
-            await self.exchange.close()
+            for symbol in symbols
+        ]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # Like asyncio.TaskGroup (not available on Python 3.10): if a symbol fails, cancel
+            # the other downloads and wait for them, so that none is left running
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        # This is the synchronous version (if you want to compare the performance)
+        # for symbol in symbols:
+        #     await _fetch_and_store_klines_for_symbol(downloader, symbol, start_date, end_date, timeframe)
 
         return results
 
-    async def _fetch_and_store_klines_for_symbol(self, symbol, start_date, end_date, timeframe):
+    async def _fetch_and_store_klines_for_symbol(
+        self, symbol, start_timestamp, end_timestamp, timeframe, return_data=False
+    ):
         """Download and store OHCLV data (klines) for a single symbol."""
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+        async with self._symbols_semaphore:
+            return await self._download_symbol(
+                symbol, start_timestamp, end_timestamp, timeframe, return_data
+            )
+
+    async def _download_symbol(
+        self, symbol, start_timestamp, end_timestamp, timeframe, return_data=False
+    ):
+        """Download the klines of a symbol and append them to its CSV file.
+
+        Returns:
+            int | list: the number of downloaded klines, or the kline batches if `return_data`.
+        """
         output_filename = self.output_dir / f"{symbol.replace('/', '_')}-{timeframe}.csv"
 
+        # Batches are only kept if requested, so that memory usage does not grow with the range
         batches = []
+        klines_count = 0
+        # Keep the file open for the whole download instead of reopening it for each batch.
+        # Opening, writing and closing it (which flushes its buffer) all happen in a separate
+        # thread, so that the event loop is never blocked by disk I/O.
+        f = None
+        write_task = None
+        rows = []
         try:
             async for batch in self._fetch_ohlcv_for_symbol(
-                symbol, start_date, end_date, timeframe=timeframe
+                symbol, start_timestamp, end_timestamp, timeframe=timeframe
             ):
-                batches.append(batch)
-                write_data_to_file(batch, output_filename)
+                if f is None:
+                    # Only create the file once there is data to write
+                    f = await asyncio.to_thread(open_csv_file, output_filename)
+                klines_count += len(batch)
+                if return_data:
+                    batches.append(batch)
+                # Accumulate several batches, to write them to disk all at once
+                rows.extend(batch)
+                if len(rows) < WRITE_BATCH_SIZE:
+                    continue
+
+                if write_task:
+                    await write_task
+                # The next batch is fetched while these rows are written to disk
+                write_task = asyncio.create_task(asyncio.to_thread(append_batch, f, rows))
+                rows = []
         except DownloaderException as ex:
             self._logger.error("An error occurred while downloading %s: %s", symbol, ex)
+        finally:
+            try:
+                if write_task:
+                    await write_task
+                if rows:
+                    await asyncio.to_thread(append_batch, f, rows)
+            finally:
+                if f is not None:
+                    await asyncio.to_thread(f.close)
 
-        return batches
+        return batches if return_data else klines_count
 
     async def _fetch_ohlcv_for_symbol(
         self,
         symbol: str,
-        start_date: datetime.datetime,
-        end_date: datetime.datetime,
+        start_timestamp: int,
+        end_timestamp: int,
         timeframe: str = "1h",
     ):
         """Download OHCLV data (klines).
 
         Args:
             symbol (str): Symbol to download (e.g.: BTC/USDT). Must be a valid symbol for Binance.
-            start_date (datetime.datetime): Start date (UTC timezone)
-            end_date (datetime.datetime): End date (UTC timezone)
+            start_timestamp (int): Start date (UTC timestamp in milliseconds)
+            end_timestamp (int): End date (UTC timestamp in milliseconds)
             timeframe (str, optional): Timeframe to download. Defaults to "1h".
 
         Yields:
@@ -142,36 +286,129 @@ class BinanceKLinesDownloader:
                 ]
 
         """
-        # Convert UTC dates to timestamps in milliseconds (needed by Binance API)
-        start_date_timestamp = int(start_date.timestamp()) * 1000  # Milliseconds
-        end_date_timestamp = int(end_date.timestamp()) * 1000  # Milliseconds
-
         if self.exchange.has["fetchOrders"]:
             self._logger.info("Download in progress: %s", symbol)
-            since = start_date_timestamp
-            while since < end_date_timestamp:
-                klines_batch = await self._fetch_ohlcv(
-                    symbol, timeframe=timeframe, start=since, end=end_date_timestamp
+            windows = self._split_date_range(start_timestamp, end_timestamp, timeframe)
+            # Tasks are created lazily: up to `max_concurrent_windows` windows are fetched at the
+            # same time, but their klines are yielded in chronological order
+            tasks = (
+                asyncio.create_task(
+                    self._fetch_window(symbol, window_start, window_end, timeframe)
                 )
+                for window_start, window_end in windows
+            )
+            pending = collections.deque(itertools.islice(tasks, self.max_concurrent_windows))
+            # Merge several pages into each yielded batch, to resume the consumer less often
+            chunk_size = self._request_limit * self.pages_per_batch
+            chunk = []
+            try:
+                while pending:
+                    klines_batches = await pending.popleft()
+                    pending.extend(itertools.islice(tasks, 1))
+                    for klines_batch in klines_batches:
+                        chunk.extend(klines_batch)
+                        if len(chunk) >= chunk_size:
+                            yield chunk
+                            chunk = []
+
+                if chunk:
+                    yield chunk
+            finally:
+                for task in pending:
+                    task.cancel()
+            self._logger.info("Download finished: %s", symbol)
 
-                if klines_batch:
-                    # Get the last timestamp and make another request from it
-                    # NOTE: we increase by 1 to avoid duplicates
-                    since = klines_batch[len(klines_batch) - 1][0] + 1
-                else:
-                    break
+    def _split_date_range(self, start: int, end: int, timeframe: str):
+        """Split a date range (timestamps in ms) into windows of one full request each.
 
-                yield klines_batch
-            self._logger.info("Download finished: %s", symbol)
+        Yields:
+            tuple[int, int]: start and end timestamps (both inclusive) of each window.
+        """
+        window_size = self._request_limit * TIMEFRAME_MS[timeframe]
+        # `end` is inclusive: it also gets a window when it falls on a window boundary
+        for window_start in range(start, end + 1, window_size):
+            yield window_start, min(window_start + window_size - 1, end)
+
+    async def _fetch_window(self, symbol: str, start: int, end: int, timeframe: str):
+        """Download the OHLCV batches between two timestamps (in ms).
+
+        Windows are sized to fit in a single request, so this loop normally makes one request. It
+        keeps paginating while Binance returns full batches, and stops on an empty or partial
+        batch, or once the end of the window is passed.
+        """
+        interval_ms = TIMEFRAME_MS[timeframe]
+        klines_batches = []
+        since = start
+        while since <= end:
+            klines_batch = await self._fetch_ohlcv(
+                symbol, timeframe=timeframe, start=since, end=end
+            )
+            if not klines_batch:
+                break
+
+            klines_batches.append(klines_batch)
+            if len(klines_batch) < self._request_limit:
+                # Binance returned all the klines up to `end`: another request would be empty
+                break
+
+            # Make another request from the next kline. After a full window this passes `end`,
+            # so no empty request is made
+            since = klines_batch[-1][0] + interval_ms
+
+        return klines_batches
 
-    def get_markets(self):
-        """Get the list of markets (symbols) available on Binance."""
-        self._logger.info("Loading markets from Binance...")
-        markets = self.exchange.load_markets()
-        self._logger.info("Markets loaded.")
+    async def get_markets(self):
+        """Get the markets (symbols) available on Binance.
 
+        Markets rarely change, so they are cached on disk for `MARKETS_CACHE_TTL` seconds and
+        loaded from Binance only when the cache is missing or expired.
+        """
+        if self._markets is not None:
+            return self._markets
+
+        self._markets = self._read_markets_cache()
+        if self._markets is not None:
+            # Make ccxt use the cached markets instead of loading them again
+            self.exchange.set_markets(self._markets)
+        else:
+            await self._open_session()
+            self._logger.info("Loading markets from Binance...")
+            self._markets = await self.exchange.load_markets()
+            self._logger.info("Loaded %d markets.", len(self._markets))
+            self._write_markets_cache(self._markets)
+
+        return self._markets
+
+    def _read_markets_cache(self) -> dict | None:
+        """Return the cached markets, or None if the cache is disabled, missing or expired."""
+        if self.markets_cache_path is None:
+            return None
+
+        try:
+            if time.time() - self.markets_cache_path.stat().st_mtime > MARKETS_CACHE_TTL:
+                return None
+            with open(self.markets_cache_path) as f:
+                markets = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        self._logger.info(
+            "Loaded %d markets from cache: %s", len(markets), self.markets_cache_path
+        )
         return markets
 
+    def _write_markets_cache(self, markets: dict):
+        """Store the markets in the cache file, if the cache is enabled."""
+        if self.markets_cache_path is None:
+            return
+
+        try:
+            self.markets_cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.markets_cache_path, "w") as f:
+                json.dump(markets, f)
+        except (OSError, TypeError) as ex:
+            self._logger.warning("Could not cache markets: %s", ex)
+
     def _instantiate_exchange(self):
         self.exchange = ccxt.binance(
             {
@@ -179,33 +416,127 @@ class BinanceKLinesDownloader:
                 "enableRateLimit": True,
             }
         )
+        if orjson is not None:
+            # Kline responses are large arrays of numbers, which orjson parses much faster
+            self.exchange.on_json_response = orjson.loads
+
+    async def _open_session(self):
+        """Create the aiohttp session used by the exchange, if it does not exist yet.
+
+        The session keeps a pool of keep-alive connections, so that the TCP and TLS handshakes are
+        reused by all the requests. ccxt closes it together with the exchange.
+        """
+        if self.exchange.session is not None:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=32,
+            limit_per_host=16,
+            keepalive_timeout=75,
+            # Resolve the Binance hostname once, instead of once per new connection
+            use_dns_cache=True,
+            ttl_dns_cache=600,
+            enable_cleanup_closed=NEEDS_CLEANUP_CLOSED,
+            ssl=ssl.create_default_context(cafile=self.exchange.cafile),
+        )
+        self.exchange.session = aiohttp.ClientSession(
+            connector=connector, trust_env=self.exchange.aiohttp_trust_env
+        )
+        self.exchange.own_session = True
 
     async def _fetch_ohlcv(self, symbol, start, end, timeframe="1h"):
         """Call the GET /api/v3/klines method of Binance API."""
-
+        # Cap the requests in flight across all symbols and windows, so that they do not pile up
+        # in the connection pool or trigger Binance's rate limits
+        async with self._requests_semaphore:
+            if self.direct_api:
+                return await self._fetch_ohlcv_direct(symbol, start, end, timeframe=timeframe)
+            return await self._fetch_ohlcv_ccxt(symbol, start, end, timeframe=timeframe)
+
+    async def _fetch_ohlcv_ccxt(self, symbol, start, end, timeframe="1h"):
+        """Call the GET /api/v3/klines method of Binance API through ccxt."""
         # Binance has a specific end time parameter. This makes the class not generic!
-        params = {"endTime": end}  # TODO: it seems like this does not work
+        # ccxt forwards it to the klines request: the date windows rely on it not to overlap
+        params = {"endTime": end}
 
         try:
             return await self.exchange.fetch_ohlcv(
                 symbol,
                 timeframe=timeframe,
                 since=start,
-                limit=self.limit,
+                limit=self._request_limit,
                 params=params,
             )
         except BadSymbol as ex:
             raise DownloaderException(ex) from ex
 
+    async def _fetch_ohlcv_direct(self, symbol, start, end, timeframe="1h"):
+        """Call the GET /api/v3/klines method of Binance API, without going through ccxt.
+
+        Requests share the session and the rate limiter of the exchange. Klines are returned in
+        the same format as ccxt's fetch_ohlcv. Only an invalid symbol raises a
+        DownloaderException: other HTTP errors raise aiohttp.ClientResponseError.
+        """
+        params = {
+            "symbol": symbol.replace("/", ""),  # E.g.: BTC/USDT -> BTCUSDT
+            "interval": timeframe,
+            "startTime": start,
+            "endTime": end,
+            "limit": self._request_limit,
+        }
+        await self.exchange.throttle(self._klines_request_cost(params))
+        async with self.exchange.session.get(BINANCE_KLINES_URL, params=params) as response:
+            body = await response.read()
+            if response.status >= 400:
+                try:
+                    error = _loads(body)
+                except ValueError:
+                    error = {}
+                if response.status == 400 and error.get("code") == BINANCE_INVALID_SYMBOL_CODE:
+                    raise DownloaderException(f"Binance API error: {error.get('msg')}")
+                # Rate limits (429, 418) and server errors must not be skipped like a bad symbol
+                response.raise_for_status()
+
+        klines = _loads(body)
+
+        return [
+            [
+                kline[0],
+                float(kline[1]),
+                float(kline[2]),
+                float(kline[3]),
+                float(kline[4]),
+                float(kline[5]),
+            ]
+            for kline in klines
+        ]
+
+    @property
+    def _request_limit(self) -> int:
+        """The number of klines actually returned by a full request.
+
+        Binance caps the klines returned by each request, whatever the requested `limit`.
+        """
+        return min(self.limit, BINANCE_MAX_KLINES_LIMIT)
+
+    def _klines_request_cost(self, params: dict) -> float:
+        """The cost of a klines request for ccxt's rate limiter.
+
+        The cost is taken from ccxt's definition of the endpoint, so that direct requests are
+        throttled exactly like the ones made through ccxt.
+        """
+        config = self.exchange.api["public"]["get"]["klines"]
+        return self.exchange.calculate_rate_limiter_cost("public", "GET", "klines", params, config)
+
     def _preprocess_date(self, date: datetime.datetime) -> datetime.datetime:
         """Convert a datetime timezone to UTC."""
         if date.tzinfo:
-            if int(date.utcoffset().total_seconds()) != 0:
+            if date.utcoffset() != ZERO_OFFSET:
                 self._logger.warning("The given date is not in UTC timezone. Converting to UTC.")
-                return date.astimezone(pytz.utc)
+                return date.astimezone(UTC)
             else:
                 return date
 
         self._logger.warning("The given date is not timezone aware. Assuming UTC.")
 
-        return date.replace(tzinfo=pytz.utc)
+        return date.replace(tzinfo=UTC)
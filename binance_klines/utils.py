@@ -1,41 +1,94 @@
-import csv
+import calendar
 import datetime
+import functools
+import logging
 import time
 from pathlib import Path
+from typing import BinaryIO
+
+LOGGER = logging.getLogger(__name__)
 
 OHLCV_FIELDNAMES = ["timestamp", "open", "high", "low", "close", "volume"]
+# Lines end with "\r\n" like with the csv module, to stay consistent with existing files
+CSV_HEADER = (",".join(OHLCV_FIELDNAMES) + "\r\n").encode("ascii")
+SECONDS_PER_DAY = 86_400
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB, instead of the default 8 KiB
 
 
 def write_data_to_file(data: list[list], output_filename: Path):
-    """Convert to pandas dataframe and write to file."""
-    rows = []
-    # Convert each row into a dictionary with the fieldnames as keys
-    for ohlcv in data:
-        row = dict(zip(OHLCV_FIELDNAMES, ohlcv))
-        # Convert the timestamp (in ms) to datetime (e.g.: 2020-01-01 00:00:00)
-        row["timestamp"] = datetime.datetime.fromtimestamp(row["timestamp"] / 1000).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        )
+    """Append OHLCV rows to a CSV file, writing the header if the file is new."""
+    with open_csv_file(output_filename) as f:
+        append_batch(f, data)
+
+
+def open_csv_file(output_filename: Path) -> BinaryIO:
+    """Open a CSV file for appending (in binary mode).
+
+    The header is written only if the file is empty, so that the file can be kept open while
+    several batches are appended to it. The caller is responsible for closing the file.
+    """
+    f = open(output_filename, "ab", buffering=WRITE_BUFFER_SIZE)
+    if f.tell() == 0:
+        f.write(CSV_HEADER)
+    return f
+
+
+def append_batch(f, data: list[list]):
+    """Append OHLCV rows to a CSV file opened in binary mode.
 
-        rows.append(row)
+    Rows only contain ASCII characters, so they are formatted and encoded all at once, skipping
+    the csv module and the text encoding layer.
+    """
+    timestamps = _format_timestamps([ohlcv[0] for ohlcv in data])
+    f.write(
+        "".join(
+            f"{timestamp},{ohlcv[1]},{ohlcv[2]},{ohlcv[3]},{ohlcv[4]},{ohlcv[5]}\r\n"
+            for timestamp, ohlcv in zip(timestamps, data)
+        ).encode("ascii")
+    )
 
-    keep_header = not output_filename.exists()
 
-    with open(output_filename, "a+") as f:
-        writer = csv.DictWriter(f, fieldnames=OHLCV_FIELDNAMES)
-        if keep_header:
-            writer.writeheader()
-        writer.writerows(rows)
+def to_milliseconds(date: datetime.datetime) -> int:
+    """Convert a timezone-aware datetime to a UTC timestamp in milliseconds.
+
+    Sub-second precision is dropped. calendar.timegm works on integers, avoiding the float
+    conversion of datetime.timestamp().
+    """
+    return calendar.timegm(date.utctimetuple()) * 1000
+
+
+def _format_timestamps(timestamps: list[int]) -> list[str]:
+    """Convert UTC timestamps (in ms) to date strings (e.g.: 2020-01-01 00:00:00).
+
+    Klines are sorted and regularly spaced, so most of them share the same day. The date part is
+    formatted only when the day changes, while the time part is computed with integer arithmetic.
+    """
+    formatted = []
+    last_day = None
+    day_prefix = ""
+    for timestamp in timestamps:
+        day, seconds = divmod(timestamp // 1000, SECONDS_PER_DAY)
+        if day != last_day:
+            day_prefix = time.strftime("%Y-%m-%d", time.gmtime(day * SECONDS_PER_DAY))
+            last_day = day
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        formatted.append(f"{day_prefix} {hours:02d}:{minutes:02d}:{seconds:02d}")
+
+    return formatted
 
 
 def timeit(method):
-    """Decorator to measure the execution time of an async function (coroutine)."""
+    """Decorator to measure the execution time of an async function (coroutine).
+
+    The time is logged at DEBUG level.
+    """
 
+    @functools.wraps(method)
     async def timed(*args, **kwargs):
-        start = time.time()
+        start = time.perf_counter()
         result = await method(*args, **kwargs)
-        end = time.time()
-        print(f"[Time] {method.__name__} ({args!r}, {kwargs!r}): {end-start:2.2f} sec")
+        LOGGER.debug("[Time] %s: %.2f sec", method.__name__, time.perf_counter() - start)
         return result
 
     return timed
@@ -1,27 +1,73 @@
+import asyncio
 import datetime
-from unittest.mock import AsyncMock, patch
+import json
+import os
+import time
+import warnings
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import aiohttp
 import ccxt.async_support as ccxt
 import pytest
 import pytz
+from ccxt.base.errors import BadSymbol
 
+from binance_klines.constants import BINANCE_KLINES_URL, MARKETS_CACHE_TTL
 from binance_klines.downloader import BinanceKLinesDownloader, DownloaderException
 from tests.fixtures.klines import klines_batch
 
 
 @pytest.fixture()
-def downloader(klines_batch: list[list]):
+def downloader(klines_batch: list[list], tmp_path: Path):
     """Return a BinanceKLinesDownloader instance with a mocked exchange."""
-    downloader = BinanceKLinesDownloader()
+    downloader = BinanceKLinesDownloader(
+        output_dir=tmp_path, markets_cache_path=tmp_path / "markets.json"
+    )
 
     exchange_mock = AsyncMock(spec=ccxt.binance)
     exchange_mock.fetch_ohlcv.return_value = klines_batch
+    exchange_mock.load_markets.return_value = {"BTC/USDT": {"id": "BTCUSDT", "symbol": "BTC/USDT"}}
     downloader.exchange = exchange_mock
     return downloader
 
+
+def binance_fetch_ohlcv(interval_ms: int):
+    """Return a fetch_ohlcv mock that generates klines like Binance.
+
+    Each request returns at most 1000 klines, opening between `since` and the (inclusive)
+    endTime.
+    """
+
+    async def fetch_ohlcv(symbol, timeframe, since, limit, params):
+        first = -(-since // interval_ms) * interval_ms
+        timestamps = range(first, params["endTime"] + 1, interval_ms)[: min(limit, 1000)]
+        return [[timestamp, 1.0, 1.0, 1.0, 1.0, 0.0] for timestamp in timestamps]
+
+    return fetch_ohlcv
+
+
+def mock_direct_api(downloader: BinanceKLinesDownloader, status: int, body: bytes) -> AsyncMock:
+    """Make the downloader call the Binance API directly, and return the mocked response."""
+    response = AsyncMock(status=status)
+    response.read.return_value = body
+    # Like aiohttp: raise_for_status is synchronous and raises for error statuses
+    response.raise_for_status = MagicMock()
+    if status >= 400:
+        response.raise_for_status.side_effect = aiohttp.ClientResponseError(
+            MagicMock(), (), status=status
+        )
+    downloader.exchange.session = MagicMock()
+    downloader.exchange.session.get.return_value.__aenter__.return_value = response
+    downloader.direct_api = True
+    return response
+
+
 @pytest.mark.asyncio
-@patch("binance_klines.downloader.write_data_to_file")
-async def test_fetch_klines(write_data_to_file_mock, downloader: BinanceKLinesDownloader, klines_batch: list[list]):
+@patch("binance_klines.downloader.append_batch")
+async def test_fetch_klines(
+    append_batch_mock, downloader: BinanceKLinesDownloader, klines_batch: list[list]
+):
     """The fetch_klines method returns the klines batches from Binance."""
     start_date = datetime.datetime(2020, 9, 1).replace(tzinfo=pytz.utc)
     start_timestamp = int(start_date.timestamp()) * 1000  # milliseconds
@@ -33,8 +79,10 @@ async def test_fetch_klines(write_data_to_file_mock, downloader: BinanceKLinesDo
         start_date=start_date,
         end_date=end_date,
         timeframe="30m",
+        return_data=True,
     )
 
+    downloader.exchange.load_markets.assert_called_once()
     downloader.exchange.fetch_ohlcv.assert_called_once_with(
         "BTC/USDT",
         timeframe="30m",
@@ -44,7 +92,215 @@ async def test_fetch_klines(write_data_to_file_mock, downloader: BinanceKLinesDo
     )
 
     assert results[0][0] == klines_batch
-    write_data_to_file_mock.assert_called_once()
+    append_batch_mock.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_stdlib_utc(
+    downloader: BinanceKLinesDownloader, klines_batch: list[list]
+):
+    """The fetch_klines method accepts dates with the datetime.timezone.utc timezone."""
+    start_date = datetime.datetime(2020, 9, 1, tzinfo=datetime.timezone.utc)
+    end_date = datetime.datetime(2020, 9, 2, tzinfo=datetime.timezone.utc)
+
+    results = await downloader.fetch_klines(
+        symbols=["BTC/USDT"],
+        start_date=start_date,
+        end_date=end_date,
+        timeframe="30m",
+    )
+
+    downloader.exchange.fetch_ohlcv.assert_called_once()
+    # Without return_data, only the number of downloaded klines is returned
+    assert results[0] == len(klines_batch)
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_limit_above_binance_cap(downloader: BinanceKLinesDownloader):
+    """No klines are lost when `limit` is higher than the 1000 klines returned by Binance."""
+    start_date = datetime.datetime(2022, 7, 18).replace(tzinfo=pytz.utc)
+    end_date = datetime.datetime(2022, 7, 20).replace(tzinfo=pytz.utc)
+    downloader.limit = 1500
+
+    downloader.exchange.fetch_ohlcv.side_effect = binance_fetch_ohlcv(60_000)
+
+    results = await downloader.fetch_klines(
+        symbols=["BTC/USDT"],
+        start_date=start_date,
+        end_date=end_date,
+        timeframe="1m",
+    )
+
+    assert results == [2 * 24 * 60 + 1]
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_windows_do_not_overlap(downloader: BinanceKLinesDownloader):
+    """Each kline is downloaded exactly once, even if the start is not aligned to a window."""
+    start_date = datetime.datetime(2022, 7, 18, 0, 30).replace(tzinfo=pytz.utc)
+    end_date = datetime.datetime(2022, 7, 20).replace(tzinfo=pytz.utc)
+    downloader.limit = 7
+    downloader.exchange.fetch_ohlcv.side_effect = binance_fetch_ohlcv(3_600_000)
+
+    results = await downloader.fetch_klines(
+        symbols=["BTC/USDT"],
+        start_date=start_date,
+        end_date=end_date,
+        timeframe="1h",
+        return_data=True,
+    )
+
+    first_date = datetime.datetime(2022, 7, 18, 1).replace(tzinfo=pytz.utc)  # First full hour
+    first_timestamp = int(first_date.timestamp()) * 1000  # milliseconds
+    end_timestamp = int(end_date.timestamp()) * 1000  # milliseconds
+    timestamps = [kline[0] for batch in results[0] for kline in batch]
+    assert timestamps == list(range(first_timestamp, end_timestamp + 1, 3_600_000))
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_stops_on_partial_batch(
+    downloader: BinanceKLinesDownloader, klines_batch: list[list]
+):
+    """No more requests are made once Binance returns fewer klines than the limit."""
+    start_date = datetime.datetime(2022, 7, 18).replace(tzinfo=pytz.utc)
+    end_date = datetime.datetime(2022, 7, 20).replace(tzinfo=pytz.utc)
+    downloader.exchange.fetch_ohlcv.side_effect = [klines_batch[:100]]
+
+    results = await downloader.fetch_klines(
+        symbols=["BTC/USDT"],
+        start_date=start_date,
+        end_date=end_date,
+        timeframe="1d",  # A single window of 500 days
+        return_data=True,
+    )
+
+    downloader.exchange.fetch_ohlcv.assert_called_once()
+    assert results[0] == [klines_batch[:100]]
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_bad_symbol(downloader: BinanceKLinesDownloader):
+    """No output file is created for a symbol that cannot be downloaded."""
+    start_date = datetime.datetime(2020, 9, 1).replace(tzinfo=pytz.utc)
+    end_date = datetime.datetime(2020, 9, 2).replace(tzinfo=pytz.utc)
+    downloader.exchange.fetch_ohlcv.side_effect = BadSymbol("binance does not have market symbol")
+
+    results = await downloader.fetch_klines(["FOO/BAR"], start_date, end_date, timeframe="30m")
+
+    assert results == [0]
+    assert not (downloader.output_dir / "FOO_BAR-30m.csv").exists()
+
+
+@pytest.mark.asyncio
+async def test_context_manager_closes_exchange(downloader: BinanceKLinesDownloader):
+    """The exchange is closed when leaving the context, not after each fetch_klines call."""
+    start_date = datetime.datetime(2020, 9, 1).replace(tzinfo=pytz.utc)
+    end_date = datetime.datetime(2020, 9, 2).replace(tzinfo=pytz.utc)
+
+    async with downloader:
+        await downloader.fetch_klines(["BTC/USDT"], start_date, end_date, timeframe="30m")
+        await downloader.fetch_klines(["ETH/USDT"], start_date, end_date, timeframe="30m")
+        downloader.exchange.close.assert_not_called()
+
+    downloader.exchange.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_open_session_no_warnings():
+    """The session is created without deprecation warnings from aiohttp."""
+    downloader = BinanceKLinesDownloader()
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        await downloader._open_session()
+
+    assert downloader.exchange.session is not None
+    await downloader.close()
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_direct_api(downloader: BinanceKLinesDownloader):
+    """With direct_api, klines are fetched from the Binance API without going through ccxt."""
+    start_date = datetime.datetime(2020, 9, 1).replace(tzinfo=pytz.utc)
+    start_timestamp = int(start_date.timestamp()) * 1000  # milliseconds
+    end_date = datetime.datetime(2020, 9, 2).replace(tzinfo=pytz.utc)
+    end_timestamp = int(end_date.timestamp()) * 1000  # milliseconds
+
+    body = json.dumps(
+        [[1658102400000, "0.602", "0.603", "0.601", "0.602", "10.5", 1658102459999, "6.3"]]
+    ).encode()
+    mock_direct_api(downloader, 200, body)
+
+    results = await downloader.fetch_klines(
+        symbols=["BTC/USDT"],
+        start_date=start_date,
+        end_date=end_date,
+        timeframe="30m",
+        return_data=True,
+    )
+
+    downloader.exchange.fetch_ohlcv.assert_not_called()
+    downloader.exchange.session.get.assert_called_once_with(
+        BINANCE_KLINES_URL,
+        params={
+            "symbol": "BTCUSDT",
+            "interval": "30m",
+            "startTime": start_timestamp,
+            "endTime": end_timestamp,
+            "limit": 500,
+        },
+    )
+    assert results[0] == [[[1658102400000, 0.602, 0.603, 0.601, 0.602, 10.5]]]
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_direct_api_invalid_symbol(downloader: BinanceKLinesDownloader):
+    """With direct_api, an invalid symbol is skipped like with ccxt."""
+    start_date = datetime.datetime(2020, 9, 1).replace(tzinfo=pytz.utc)
+    end_date = datetime.datetime(2020, 9, 2).replace(tzinfo=pytz.utc)
+
+    response = mock_direct_api(downloader, 400, b'{"code": -1121, "msg": "Invalid symbol."}')
+
+    results = await downloader.fetch_klines(["FOO/BAR"], start_date, end_date, timeframe="30m")
+
+    assert results == [0]
+    response.raise_for_status.assert_not_called()
+    assert not (downloader.output_dir / "FOO_BAR-30m.csv").exists()
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_direct_api_rate_limited(downloader: BinanceKLinesDownloader):
+    """With direct_api, rate limit errors are raised instead of skipping the symbol."""
+    start_date = datetime.datetime(2020, 9, 1).replace(tzinfo=pytz.utc)
+    end_date = datetime.datetime(2020, 9, 2).replace(tzinfo=pytz.utc)
+
+    mock_direct_api(downloader, 429, b'{"code": -1003, "msg": "Too many requests."}')
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await downloader.fetch_klines(["BTC/USDT"], start_date, end_date, timeframe="30m")
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_cancels_other_symbols(downloader: BinanceKLinesDownloader):
+    """If the download of a symbol fails, the downloads of the other symbols are cancelled."""
+    start_date = datetime.datetime(2020, 9, 1).replace(tzinfo=pytz.utc)
+    end_date = datetime.datetime(2020, 9, 2).replace(tzinfo=pytz.utc)
+    cancelled = asyncio.Event()
+
+    async def fetch_ohlcv(symbol, **kwargs):
+        if symbol == "BTC/USDT":
+            raise RuntimeError("Unexpected error")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    downloader.exchange.fetch_ohlcv.side_effect = fetch_ohlcv
+
+    with pytest.raises(RuntimeError):
+        await downloader.fetch_klines(["BTC/USDT", "ETH/USDT"], start_date, end_date, "30m")
+
+    assert cancelled.is_set()
 
 
 @pytest.mark.asyncio
@@ -64,3 +320,69 @@ async def test_fetch_klines_wrong_timeframe(downloader: BinanceKLinesDownloader)
         )
 
     downloader.exchange.fetch_ohlcv.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_fetch_klines_split_date_range(
+    downloader: BinanceKLinesDownloader, klines_batch: list[list]
+):
+    """The fetch_klines method splits the date range into windows of `limit` klines."""
+    start_date = datetime.datetime(2020, 9, 1).replace(tzinfo=pytz.utc)
+    start_timestamp = int(start_date.timestamp()) * 1000  # milliseconds
+    end_date = datetime.datetime(2020, 9, 2).replace(tzinfo=pytz.utc)
+    end_timestamp = int(end_date.timestamp()) * 1000  # milliseconds
+    window_size = 500 * 60 * 1000  # 500 klines of 1 minute
+
+    results = await downloader.fetch_klines(
+        symbols=["BTC/USDT"],
+        start_date=start_date,
+        end_date=end_date,
+        timeframe="1m",
+        return_data=True,
+    )
+
+    calls = downloader.exchange.fetch_ohlcv.call_args_list
+    assert [(call.kwargs["since"], call.kwargs["params"]["endTime"]) for call in calls] == [
+        (start_timestamp, start_timestamp + window_size - 1),
+        (start_timestamp + window_size, start_timestamp + 2 * window_size - 1),
+        (start_timestamp + 2 * window_size, end_timestamp),
+    ]
+    # The three pages are merged into a single batch
+    assert len(results[0]) == 1
+    assert len(results[0][0]) == 3 * len(klines_batch)
+
+
+@pytest.mark.asyncio
+async def test_get_markets_writes_cache(downloader: BinanceKLinesDownloader):
+    """The get_markets method loads the markets from Binance and caches them on disk."""
+    markets = {"BTC/USDT": {"id": "BTCUSDT", "symbol": "BTC/USDT"}}
+    downloader.exchange.load_markets.return_value = markets
+
+    assert await downloader.get_markets() == markets
+    downloader.exchange.load_markets.assert_called_once()
+    assert json.loads(downloader.markets_cache_path.read_text()) == markets
+
+
+@pytest.mark.asyncio
+async def test_get_markets_reads_cache(downloader: BinanceKLinesDownloader):
+    """The get_markets method does not call Binance if the markets are cached."""
+    markets = {"BTC/USDT": {"id": "BTCUSDT", "symbol": "BTC/USDT"}}
+    downloader.markets_cache_path.write_text(json.dumps(markets))
+
+    assert await downloader.get_markets() == markets
+    assert await downloader.get_markets() == markets
+    downloader.exchange.load_markets.assert_not_called()
+    downloader.exchange.set_markets.assert_called_once_with(markets)
+
+
+@pytest.mark.asyncio
+async def test_get_markets_expired_cache(downloader: BinanceKLinesDownloader):
+    """The get_markets method loads the markets from Binance if the cache is expired."""
+    markets = {"BTC/USDT": {"id": "BTCUSDT", "symbol": "BTC/USDT"}}
+    downloader.exchange.load_markets.return_value = markets
+    downloader.markets_cache_path.write_text(json.dumps({}))
+    expired_time = time.time() - MARKETS_CACHE_TTL - 1
+    os.utime(downloader.markets_cache_path, (expired_time, expired_time))
+
+    assert await downloader.get_markets() == markets
+    downloader.exchange.load_markets.assert_called_once()
@@ -0,0 +1,30 @@
+import datetime
+from pathlib import Path
+
+import pytz
+
+from binance_klines.utils import to_milliseconds, write_data_to_file
+from tests.fixtures.klines import klines_batch
+
+
+def test_write_data_to_file(tmp_path: Path, klines_batch: list[list]):
+    """The write_data_to_file function writes a header and one CSV row per kline."""
+    output_filename = tmp_path / "BTC_USDT-1m.csv"
+
+    write_data_to_file(klines_batch[:2], output_filename)
+    write_data_to_file(klines_batch[2:3], output_filename)
+
+    assert output_filename.read_text().splitlines() == [
+        "timestamp,open,high,low,close,volume",
+        "2022-07-18 00:00:00,0.602,0.602,0.602,0.602,0.0",
+        "2022-07-18 00:01:00,0.602,0.602,0.602,0.602,0.0",
+        "2022-07-18 00:02:00,0.603,0.603,0.601,0.601,428.11",
+    ]
+
+
+def test_to_milliseconds():
+    """The to_milliseconds function converts dates to UTC timestamps in milliseconds."""
+    date = datetime.datetime(2022, 7, 18, 0, 1, 30, 999999, tzinfo=datetime.timezone.utc)
+
+    assert to_milliseconds(date) == 1658102490000
+    assert to_milliseconds(date.astimezone(pytz.timezone("Europe/Rome"))) == 1658102490000